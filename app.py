@@ -4,21 +4,64 @@ import duckdb
 import numpy as np
 import pandas as pd
 import gc
+import hmac # Constant-time passcode comparison
+import hashlib # Keys for the on-disk residential index cache
 import os
 import traceback
+import logging
 import re
-# import pyarrow.parquet as pq # Needed only if using load_parquet_from_b2
+import threading
+import tempfile
+import shutil
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq # Parquet schema inspection
 import io # Required for reading bytes data into pyarrow/pandas
 import json # Required for parsing GeoJSON
+import orjson # Fast JSON serialization for GeoJSON responses
+import shapely # Vectorized geometry -> GeoJSON conversion
+from pyproj import Transformer # Coordinate reprojection on load
+from concurrent.futures import ThreadPoolExecutor # Parallel reprojection chunks
+try:
+    from numba import njit, types # Optional: compiled residential-index kernel
+except ImportError:
+    njit = None
 import boto3 # Import boto3 for B2 access
 from botocore.client import Config # For B2 S3 config
-from functools import wraps  # For login decorator
+from botocore.exceptions import ClientError # Missing optional B2 objects
+from functools import wraps, lru_cache  # For login decorator / memoized residential indices
+from flask_compress import Compress # Response compression (gzip/brotli)
+from flask.json.provider import DefaultJSONProvider # Base for the orjson-backed provider
 from flask import (Flask, render_template, request, redirect,
-                     url_for, session, flash, jsonify)
+                     url_for, session, flash, jsonify, Response, stream_with_context)
+
+# --- Logging ---
+# Request handlers log through `logger`; debug messages (and their formatting) are skipped unless FLASK_DEBUG=1
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if os.environ.get('FLASK_DEBUG') == '1' else logging.INFO)
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, used by jsonify, request.get_json and the session."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = OrjsonProvider(app)
+
+# Compress JSON/GeoJSON responses; streamed ones are compressed chunk by chunk (brotli/deflate).
+# Level 4 trades a little compression ratio for CPU.
+app.config['COMPRESS_MIMETYPES'] = ['application/json', 'application/geo+json', 'application/geo+json-seq']
+app.config['COMPRESS_LEVEL'] = 4 # gzip
+app.config['COMPRESS_BR_LEVEL'] = 4 # brotli
+Compress(app)
+
 # --- Authentication Setup ---
 # 1. Load Secret Key (Required for sessions)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY')
@@ -50,50 +93,239 @@ B2_BUCKET_NAME = os.environ.get('B2_BUCKET_NAME')
 
 # --- Define B2 OBJECT KEYS (Update these with your exact filenames/paths in B2) ---
 GEOJSON_OBJECT_KEY = 'data_residential.geojson'
+# Optional GeoParquet copy of the GeoJSON (see convert_to_geoparquet.py); loaded instead when present
+GEOPARQUET_OBJECT_KEY = 'data_residential.geoparquet'
 PARQUET_OBJECT_KEY = 'full_data.parquet'
 # Example if in a 'data' folder:
 # GEOJSON_OBJECT_KEY = 'data/data_residential.geojson'
 # PARQUET_OBJECT_KEY = 'data/full_data.parquet'
 
+# --- Local Data Settings ---
+# Memory cap for DuckDB while preprocessing the Parquet file
+DUCKDB_MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT', '1GB')
+# Features serialized per chunk when streaming GeoJSON responses
+FEATURE_CHUNK_SIZE = int(os.environ.get('FEATURE_CHUNK_SIZE', '1000'))
+# Opt-in directory (owned by the app) residential index arrays are persisted to across restarts;
+# unset or empty disables the disk cache. Files are never evicted, so point it at a dedicated directory
+RESIDENTIAL_INDEX_CACHE_DIR = os.environ.get('RESIDENTIAL_INDEX_CACHE_DIR', '')
+
+# --- GeoJSON Column Types ---
+# Columns with these suffixes hold measures and are stored as float32
+FLOAT32_SUFFIXES = ('_o', '_zscore_o', '_cap', '_rate', '_per_cap')
+# Low-cardinality text columns stored as categoricals (each distinct string kept once). Other text
+# columns become categoricals too when at most half their values are distinct.
+CATEGORICAL_COLS = {'race', 'COUNTYFP'}
+
 
 # --- Global State Variables ---
 # Use these to hold data loaded from B2
-global_gdf = None # Will hold GeoDataFrame loaded from GeoJSON
-parquet_df = None # Will hold DataFrame loaded from Parquet
-# Set to track generated column names
-generated_index_columns = set()
-# List to track columns confirmed available in the loaded GeoJSON (updated on load and generation)
-available_geojson_columns = []
+global_gdf = None # Will hold the attribute table (DataFrame) of the features loaded from GeoJSON
+global_geometry_json = None # Pre-rendered GeoJSON geometry (UTF-8 bytes) per feature, row-aligned with global_gdf
+global_props_table = None # Arrow copy of global_gdf's columns served by /geojson, plus the generated index columns
+static_property_columns = set() # Frontend columns loaded from GeoJSON, never changed after load
+global_static_props_json = None # Per feature, the static properties as serialized JSON members (no braces)
+# Memory map of this process's sorted Parquet file (None if not loaded). The file is unlinked once mapped,
+# so no other process can replace it under the cached footer, weights and tract offsets below
+parquet_buffer = None
+parquet_columns = set() # Column names present in the Parquet file (set on load)
+parquet_tract_ids = None # Distinct Origin_tract values (int64) in file order (set on load)
+parquet_group_starts = None # Row offset where each tract's contiguous run starts (set on load)
+parquet_perc_visit = None # perc_visit weight per Parquet row (float32, file order, set on load)
+parquet_metadata = None # Parsed footer of the sorted Parquet file, reused so requests skip re-reading it
+# Generated index columns kept beside global_gdf (which never grows): name -> float32 array row-aligned with it
+generated_index_values = {}
+# Columns confirmed available in the loaded GeoJSON (updated on load and generation); an
+# insertion-ordered dict with None values, ordered like a list with O(1) membership like a set
+available_geojson_columns = {}
 # List to store columns confirmed needed by frontend AND present in GeoJSON (set on load)
 verified_frontend_cols = []
 # List to store JS variable names whose _zscore_o cols exist (set on load)
 available_residential_vars_js = []
 # Mapping from JS var names to backend base names (set on load)
 variable_name_map_js_to_backend = {}
+# Mapping from JS var names to their available _zscore_o column (set on load)
+residential_zscore_cols_js = {}
+# Hash index of integer Origin_tract values, and the global_gdf row each entry points to (set on load)
+tract_index = None
+tract_index_rows = None
+# Every _zscore_o column as one row-major float32 matrix, and each column's position in it (set on load)
+zscore_matrix = None
+zscore_column_index = {}
+# SHA-1 of zscore_matrix and its column names, so on-disk indices are only reused for the same data (set on load)
+zscore_matrix_digest = None
 # S3 Client instance
 s3_client = None
+# Persistent DuckDB connection (used on startup to preprocess the Parquet file)
+duck_con = None
+# Serializes index column writes (generated_index_values + global_props_table) across request threads
+index_column_lock = threading.Lock()
+# Bumped on every index column write, so cached responses built before it are never reused
+index_state_version = 0
+# Body chunks of the last fully streamed feature response, keyed by (format, columns, index_state_version)
+feature_response_cache = {}
+# Result of get_columns_for_frontend, keyed by index_state_version (reset on load)
+frontend_columns_cache = {}
 
 # --- Helper Functions ---
-def report_memory(stage=""):
-    """Simple memory reporting for global_gdf and parquet_df."""
+def report_memory(stage="", deep=True):
+    """
+    Simple memory reporting for global_gdf and its Arrow properties table.
+    deep=False skips measuring the Python objects in object/category columns (cheap, for request paths).
+    """
     mem_usage_gdf = 0
-    mem_usage_pq = 0
+    mem_usage_props = 0
     if global_gdf is not None:
         try:
-            mem_usage_gdf = global_gdf.memory_usage(index=True, deep=True).sum() / (1024**2)
+            mem_usage_gdf = global_gdf.memory_usage(index=True, deep=deep).sum() / (1024**2)
         except Exception as e:
             print(f"Could not report memory usage for GDF: {e}")
-    if parquet_df is not None:
-        try:
-            mem_usage_pq = parquet_df.memory_usage(deep=True).sum() / (1024**2)
-        except Exception as e:
-            print(f"Could not report memory usage for Parquet DF: {e}")
-    print(f"Memory Usage ({stage}): GDF ~ {mem_usage_gdf:.2f} MB | Parquet DF ~ {mem_usage_pq:.2f} MB | Total ~ {mem_usage_gdf + mem_usage_pq:.2f} MB")
+    if global_props_table is not None:
+        mem_usage_props = global_props_table.nbytes / (1024**2)
+    total = mem_usage_gdf + mem_usage_props
+    print(f"Memory Usage ({stage}): GDF ~ {mem_usage_gdf:.2f} MB | Properties Table ~ {mem_usage_props:.2f} MB | Total ~ {total:.2f} MB")
+
 
+# Precompiled patterns/tables used to clean names
+whitespace_re = re.compile(r'\s+')
+non_word_re = re.compile(r'[^\w_]')
+strip_spaces_table = str.maketrans('', '', ' ')
+
+def quote_ident(name):
+    """Quotes a column name for DuckDB SQL (identifiers cannot be bound as parameters)."""
+    return '"' + name.replace('"', '""') + '"'
 
 def clean_col_name(name):
     """Cleans variable names for backend use (removes spaces)."""
-    return name.replace(' ', '')
+    return name.translate(strip_spaces_table)
+
+def clean_index_name(name):
+    """Cleans a user-supplied index name (whitespace -> '_', other non-word characters dropped)."""
+    return non_word_re.sub('', whitespace_re.sub('_', name))
+
+def fits_float32(series):
+    """True if a numeric column survives a float32 round trip exactly (e.g. large integer ids do not)."""
+    try:
+        return series.astype('float32').astype(series.dtype).equals(series)
+    except (ValueError, TypeError, OverflowError):
+        return False
+
+def to_tract_int(series):
+    """
+    Normalizes Origin_tract values to int64 keys (e.g. '36061000100.0' -> 36061000100).
+    Runs as Arrow casts in C; non-numeric values become missing.
+    """
+    numeric_tracts = pa.array(pd.to_numeric(series, errors='coerce'), from_pandas=True)
+    tract_ints = pc.cast(numeric_tracts, pa.int64(), safe=False)
+    return pd.Series(pd.array(tract_ints, dtype='int64[pyarrow]'), index=series.index)
+
+def shortest_float64(values):
+    """
+    Widens float32 `values` (Arrow array/column) to the float64 nearest each value's shortest decimal
+    form, so Python floats from them print as e.g. 0.1 rather than 0.10000000149011612 while still
+    round-tripping to the same float32. One vectorized pass instead of per-element conversion.
+    """
+    return pc.cast(pc.cast(values, pa.string()), pa.float64())
+
+def frontend_properties(columns):
+    """
+    Selects `columns` from global_props_table, with Origin_tract formatted as strings for the frontend.
+    float32 columns go through shortest_float64 so they serialize in their shortest form.
+    """
+    table = global_props_table.select(columns)
+    if 'Origin_tract' in table.column_names:
+        position = table.column_names.index('Origin_tract')
+        table = table.set_column(position, 'Origin_tract', pc.cast(table.column(position), pa.string()))
+    for position, field in enumerate(table.schema):
+        if pa.types.is_float32(field.type):
+            table = table.set_column(position, field.name, shortest_float64(table.column(position)))
+    return table
+
+def reproject_to_wgs84(geometries, source_crs):
+    """
+    Reprojects an array of shapely geometries to EPSG:4326. The flat 2D coordinate buffer is
+    split across threads, each with its own pyproj Transformer (pyproj releases the GIL).
+    """
+    if shapely.has_z(geometries).any(): # Only 2D coordinates are transformed below
+        return gpd.GeoSeries(geometries, crs=source_crs).to_crs(epsg=4326).values
+    coords = shapely.get_coordinates(geometries)
+    workers = os.cpu_count() or 1
+    bounds = np.linspace(0, len(coords), workers + 1, dtype=np.int64)
+
+    def transform_chunk(start, stop):
+        transformer = Transformer.from_crs(source_crs, "EPSG:4326", always_xy=True) # Not thread-safe, one per chunk
+        coords[start:stop, 0], coords[start:stop, 1] = transformer.transform(coords[start:stop, 0], coords[start:stop, 1])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(transform_chunk, bounds[:-1], bounds[1:]))
+    return shapely.set_coordinates(geometries.copy(), coords) # Fills a new array, the input is left untouched
+
+def row_nanmean_x100_numpy(values):
+    """Row-wise NaN-skipping mean * 100 of a 2D float32 array; rows with no values are NaN."""
+    valid_counts = (~np.isnan(values)).sum(axis=1).astype(np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(values, axis=1) / valid_counts * np.float32(100.0)
+
+if njit is not None:
+    # Compiled eagerly at import (explicit signature) so the first request pays no JIT cost; the input
+    # is typed read-only, which writable and read-only arrays of any layout both dispatch to.
+    # Serial on purpose: request threads call it concurrently, and numba's fallback (workqueue)
+    # threading layer aborts the process on concurrent parallel launches; the matrix is small anyway
+    @njit([types.float32[:](types.Array(types.float32, 2, 'A', readonly=True))])
+    def row_nanmean_x100(values):
+        """Row-wise NaN-skipping mean * 100 of a 2D float32 array, in a single compiled pass."""
+        out = np.empty(values.shape[0], dtype=np.float32)
+        for i in range(values.shape[0]):
+            total = 0.0
+            count = 0
+            for j in range(values.shape[1]):
+                v = values[i, j]
+                if not np.isnan(v):
+                    total += v
+                    count += 1
+            out[i] = total / count * 100.0 if count else np.nan
+        return out
+else:
+    row_nanmean_x100 = row_nanmean_x100_numpy
+
+@lru_cache(maxsize=64)
+def residential_index_values(zscore_cols):
+    """
+    Residential index (row-wise NaN-skipping mean * 100) over the sorted tuple `zscore_cols` of
+    zscore_matrix columns. Memoized, so toggling back to a variable set costs nothing; the cache
+    is cleared whenever zscore_matrix is rebuilt. When RESIDENTIAL_INDEX_CACHE_DIR is set, results
+    are also kept there as .npy files, keyed by the data digest and columns, to survive restarts.
+    The returned array is read-only as it is shared.
+    """
+    cache_path = None
+    if RESIDENTIAL_INDEX_CACHE_DIR:
+        cache_key = hashlib.sha1(f"{zscore_matrix_digest}:{','.join(zscore_cols)}".encode()).hexdigest()
+        cache_path = os.path.join(RESIDENTIAL_INDEX_CACHE_DIR, f"{cache_key}.npy")
+        try:
+            index_values = np.load(cache_path, mmap_mode='r') # Read-only; pages in on first use
+            if index_values.shape == (zscore_matrix.shape[0],) and index_values.dtype == np.float32:
+                return index_values
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable residential index cache file %s: %s", cache_path, e)
+
+    zscores = np.take(zscore_matrix, [zscore_column_index[col] for col in zscore_cols], axis=1) # Stays row-major
+    index_values = row_nanmean_x100(zscores)
+    index_values.flags.writeable = False
+    if cache_path:
+        partial_path = None
+        try:
+            os.makedirs(RESIDENTIAL_INDEX_CACHE_DIR, exist_ok=True)
+            # A unique temp file per call (request threads share the pid), then an atomic rename into
+            # place, so concurrent writers never share a file and readers never see a partial one
+            with tempfile.NamedTemporaryFile(dir=RESIDENTIAL_INDEX_CACHE_DIR, suffix='.part', delete=False) as cache_file:
+                partial_path = cache_file.name
+                np.save(cache_file, index_values)
+            os.replace(partial_path, cache_path)
+        except OSError as e:
+            logger.warning("Could not persist residential index to %s: %s", cache_path, e)
+            if partial_path and os.path.exists(partial_path): os.remove(partial_path)
+    return index_values
 
 def check_gdf():
     """Checks if global_gdf is loaded."""
@@ -103,11 +335,17 @@ def check_gdf():
 def get_columns_for_frontend():
     """
     Determines which columns currently exist in global_gdf and should be sent.
+    'geometry' is included when the pre-rendered geometries are loaded. Returns a sorted tuple,
+    memoized until the next index column write; being immutable, it is safe to share.
     """
-    global global_gdf, verified_frontend_cols, generated_index_columns
-    if global_gdf is None: return []
+    global global_gdf, verified_frontend_cols, generated_index_values, frontend_columns_cache
+    if global_gdf is None: return ()
+    state_version = index_state_version
+    cached_cols = frontend_columns_cache.get(state_version)
+    if cached_cols is not None: return cached_cols
 
-    current_gdf_cols = set(global_gdf.columns)
+    current_gdf_cols = set(global_gdf.columns).union(generated_index_values)
+    if global_geometry_json is not None: current_gdf_cols.add('geometry')
 
     # Start with essential and verified columns known to be needed
     cols_to_send = set(verified_frontend_cols)
@@ -118,18 +356,122 @@ def get_columns_for_frontend():
     cols_to_send.add('race')
 
     # Add any dynamically generated index columns that exist
-    for idx_col in generated_index_columns:
+    for idx_col in generated_index_values:
         if idx_col in current_gdf_cols:
              cols_to_send.add(idx_col)
 
     # Filter against actual columns currently in the dataframe for safety
-    final_cols = sorted(list(cols_to_send.intersection(current_gdf_cols)))
+    final_cols = tuple(sorted(cols_to_send.intersection(current_gdf_cols)))
 
-    # print(f"DEBUG get_columns_for_frontend: Sending columns ({len(final_cols)}): {final_cols}")
     if 'geometry' not in final_cols:
-         print("CRITICAL WARNING in get_columns_for_frontend: 'geometry' column missing!")
+         logger.critical("get_columns_for_frontend: 'geometry' column missing!")
+    frontend_columns_cache = {state_version: final_cols}
     return final_cols
 
+def json_default(obj):
+    """orjson fallback for values it cannot serialize natively (pandas NA -> null, numpy scalars -> Python)."""
+    if obj is pd.NA: return None
+    if isinstance(obj, np.generic): return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def set_index_column(name, values):
+    """
+    Stores generated index `name` in generated_index_values and global_props_table, or overwrites
+    it on regeneration. Held under index_column_lock so concurrent requests cannot lose an update.
+    """
+    global global_props_table, index_state_version
+    column = pa.array(values, from_pandas=True) # NaN -> null
+    with index_column_lock:
+        generated_index_values[name] = values
+        if name in global_props_table.column_names:
+            global_props_table = global_props_table.set_column(global_props_table.column_names.index(name), name, column)
+        else:
+            global_props_table = global_props_table.append_column(name, column)
+        index_state_version += 1
+
+def iter_feature_chunks(dynamic_properties):
+    """
+    Yields lists of up to FEATURE_CHUNK_SIZE serialized features (bytes). Each feature splices the
+    pre-rendered geometry and static properties with the generated index columns in
+    `dynamic_properties` (a pyarrow Table of numeric columns), the only values serialized per request.
+    """
+    keys = [b',' + orjson.dumps(name) + b':' for name in dynamic_properties.column_names]
+    total = len(global_static_props_json)
+    for start in range(0, total, FEATURE_CHUNK_SIZE):
+        count = min(FEATURE_CHUNK_SIZE, total - start)
+        chunk = dynamic_properties.slice(start, count)
+        # One orjson call per column per chunk; numbers/null contain no commas, so splitting is safe.
+        # Float columns go through numpy so float32 is written in its shortest form (NaN/null -> null)
+        value_columns = [orjson.dumps(column.to_numpy() if pa.types.is_floating(column.type) else column.to_pylist(),
+                                      option=orjson.OPT_SERIALIZE_NUMPY)[1:-1].split(b',')
+                         for column in chunk.columns]
+        features = []
+        for i in range(count):
+            props = global_static_props_json[start + i]
+            for key, values in zip(keys, value_columns): props += key + values[i]
+            features.append(b'{"type":"Feature","geometry":' + global_geometry_json[start + i]
+                            + b',"properties":{' + props + b'}}')
+        yield features
+
+def iter_feature_collection(dynamic_properties):
+    """Yields a GeoJSON FeatureCollection as byte chunks of up to FEATURE_CHUNK_SIZE features."""
+    yield b'{"type":"FeatureCollection","features":['
+    for n, features in enumerate(iter_feature_chunks(dynamic_properties)):
+        chunk = b','.join(features)
+        yield chunk if n == 0 else b',' + chunk
+    yield b']}'
+
+def iter_feature_sequence(dynamic_properties):
+    """
+    Yields the features as a GeoJSON Text Sequence (RFC 8142): each feature is prefixed with
+    an RS (0x1E) character and ends with a newline, so clients can parse them as they arrive.
+    """
+    for features in iter_feature_chunks(dynamic_properties):
+        yield b''.join(b'\x1e' + feature + b'\n' for feature in features)
+
+def cache_feature_response(key, chunks):
+    """
+    Passes `chunks` through and, once the body has been streamed in full, keeps it as the
+    single cached feature response. An aborted stream leaves the previous entry in place.
+    """
+    global feature_response_cache
+    body = []
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    feature_response_cache = {key: body} # Replaced wholesale, so readers never see a partial body
+
+def feature_collection_response(columns):
+    """
+    Streams the features with `columns` as a FeatureCollection, or as a GeoJSON Text
+    Sequence when asked for (?format=seq or Accept: application/geo+json-seq). A repeat
+    request for the same columns with no index written since replays the cached body.
+    """
+    as_sequence = request.args.get('format') == 'seq' or 'application/geo+json-seq' in request.headers.get('Accept', '')
+    mimetype = 'application/geo+json-seq' if as_sequence else 'application/json'
+    with index_column_lock:
+        # Immutable Arrow snapshot of the generated columns; static columns are pre-serialized
+        dynamic_properties = global_props_table.select(
+            [col for col in columns if col != 'geometry' and col not in static_property_columns])
+        key = (mimetype, tuple(columns), index_state_version)
+    cached_body = feature_response_cache.get(key)
+    if cached_body is not None:
+        return Response(cached_body, mimetype=mimetype)
+    chunks = iter_feature_sequence(dynamic_properties) if as_sequence else iter_feature_collection(dynamic_properties)
+    return Response(stream_with_context(cache_feature_response(key, chunks)), mimetype=mimetype)
+
+def index_values_response(name):
+    """
+    Returns generated index `name` as {"index_col": name, "values": {Origin_tract: value}} so the
+    frontend can merge it into the features it already holds, without re-sending any geometry.
+    Tracts without a value are left out.
+    """
+    tract_values = generated_index_values[name][tract_index_rows]
+    has_value = ~np.isnan(tract_values)
+    # Keys and values are converted to Python objects column-wise, not per numpy scalar
+    values = dict(zip(tract_index[has_value].astype(str), shortest_float64(pa.array(tract_values[has_value])).to_pylist()))
+    return Response(orjson.dumps({"index_col": name, "values": values}), mimetype='application/json')
+
 # --- S3 Client Initialization ---
 def initialize_s3_client():
     """Initializes the Boto3 S3 client for B2."""
@@ -154,18 +496,38 @@ def initialize_s3_client():
         return False
 
 # --- Data Loading Functions from B2 ---
+def read_tract_features_from_b2():
+    """
+    Reads the tract features from B2, preferring the GeoParquet copy (columnar, WKB geometry,
+    no JSON parsing) and falling back to the GeoJSON when it cannot be fetched.
+    """
+    try:
+        response = s3_client.get_object(Bucket=B2_BUCKET_NAME, Key=GEOPARQUET_OBJECT_KEY)
+    except ClientError as e:
+        # The GeoParquet copy is optional: a missing key may also surface as AccessDenied (403) when the
+        # key lacks ListBucket, so any client error falls back to the GeoJSON instead of aborting the load
+        logger.warning("Could not fetch GeoParquet key '%s' (%s), loading GeoJSON key '%s' instead.",
+                       GEOPARQUET_OBJECT_KEY, e.response.get('Error', {}).get('Code', e), GEOJSON_OBJECT_KEY)
+    else:
+        gdf_loaded = gpd.read_parquet(io.BytesIO(response['Body'].read()))
+        print(f"Successfully loaded GeoParquet from B2 key: {GEOPARQUET_OBJECT_KEY}")
+        return gdf_loaded
+
+    response = s3_client.get_object(Bucket=B2_BUCKET_NAME, Key=GEOJSON_OBJECT_KEY)
+    # Load directly into GeoDataFrame from bytes via pyogrio's Arrow path (much faster than Fiona)
+    gdf_loaded = gpd.read_file(io.BytesIO(response['Body'].read()), engine='pyogrio', use_arrow=True)
+    print(f"Successfully loaded and parsed GeoJSON from B2 key: {GEOJSON_OBJECT_KEY}")
+    return gdf_loaded
+
 def load_geojson_from_b2():
     """Loads GeoJSON data from B2 into the global_gdf."""
-    global global_gdf, s3_client, available_geojson_columns, verified_frontend_cols
+    global global_gdf, global_geometry_json, global_props_table, static_property_columns, global_static_props_json, tract_index, tract_index_rows, s3_client, available_geojson_columns, verified_frontend_cols, frontend_columns_cache, zscore_matrix, zscore_column_index, zscore_matrix_digest
     if not s3_client: return False # Check if client is initialized
     if not B2_BUCKET_NAME: print("Error: B2_BUCKET_NAME not configured."); return False
 
-    print(f"Attempting to load GeoJSON key '{GEOJSON_OBJECT_KEY}' from B2 bucket '{B2_BUCKET_NAME}'...")
+    print(f"Attempting to load tract features from B2 bucket '{B2_BUCKET_NAME}'...")
     try:
-        response = s3_client.get_object(Bucket=B2_BUCKET_NAME, Key=GEOJSON_OBJECT_KEY)
-        # Load directly into GeoDataFrame from bytes
-        gdf_loaded = gpd.read_file(io.BytesIO(response['Body'].read()))
-        print(f"Successfully loaded and parsed GeoJSON from B2 key: {GEOJSON_OBJECT_KEY}")
+        gdf_loaded = read_tract_features_from_b2()
 
         # --- Process Loaded GeoDataFrame ---
         initial_available_columns = gdf_loaded.columns.tolist()
@@ -178,14 +540,11 @@ def load_geojson_from_b2():
                 return False # Failed to load essential data
 
         # Robust Origin_tract Conversion (important!)
+        # Kept as int64 keys internally; formatted as strings only when sent to the frontend
         try:
-            numeric_tracts_gdf = pd.to_numeric(gdf_loaded['Origin_tract'], errors='coerce')
-            if numeric_tracts_gdf.isna().any(): print(f"WARNING: Some Origin_tract values in GeoJSON were non-numeric.")
-            # Try nullable Int64 first, fallback to standard int/float if needed
-            try: int_tracts_gdf = numeric_tracts_gdf.astype(pd.Int64Dtype())
-            except TypeError: int_tracts_gdf = numeric_tracts_gdf.astype('float64').astype('Int64') # Fallback conversion
-            gdf_loaded['Origin_tract'] = int_tracts_gdf.astype(str).str.strip()
-            print(f"DEBUG: Post-load Origin_tract GDF sample (string): {gdf_loaded['Origin_tract'].head()}")
+            gdf_loaded['Origin_tract'] = to_tract_int(gdf_loaded['Origin_tract'])
+            if gdf_loaded['Origin_tract'].isna().any(): print(f"WARNING: Some Origin_tract values in GeoJSON were non-numeric.")
+            if app.debug: print(f"DEBUG: Post-load Origin_tract GDF sample (int64): {gdf_loaded['Origin_tract'].head()}")
         except Exception as e_tract:
              print(f"ERROR processing Origin_tract in GeoJSON: {e_tract}"); return False
 
@@ -203,38 +562,99 @@ def load_geojson_from_b2():
 
         # Optimize Data Types
         print("Optimizing GeoDataFrame data types...")
+        # Target dtypes are decided from the schema once, then applied in a single astype pass
+        dtype_map = {}
         for col in gdf_loaded.columns:
             if col in ['geometry', 'Origin_tract']: continue
-            col_dtype = gdf_loaded[col].dtype
-            try:
-                if pd.api.types.is_numeric_dtype(col_dtype):
-                    gdf_loaded[col] = pd.to_numeric(gdf_loaded[col], downcast='float') # Downcast float/int
-                elif pd.api.types.is_object_dtype(col_dtype): # Object type
-                     # Try converting to numeric if possible, otherwise ignore
-                     numeric_test = pd.to_numeric(gdf_loaded[col], errors='coerce')
-                     if numeric_test.notna().sum() > 0.9 * len(gdf_loaded[col]): # If mostly numeric
-                          gdf_loaded[col] = numeric_test.astype('float32') # Convert to float32
-                     # Can add category conversion for low-cardinality strings later if needed
-            except Exception as e_opt:
-                print(f"Warning: Could not optimize column '{col}': {e_opt}")
+            if col in CATEGORICAL_COLS:
+                dtype_map[col] = 'category'
+            elif col.endswith(FLOAT32_SUFFIXES) or col in required_frontend_cols_in_geojson:
+                dtype_map[col] = 'float32' # Known measures (e.g. health columns) may arrive as text
+            elif pd.api.types.is_numeric_dtype(gdf_loaded[col].dtype):
+                # Other numeric columns are only downcast when no value changes; otherwise they keep their dtype
+                if not pd.api.types.is_bool_dtype(gdf_loaded[col].dtype) and fits_float32(gdf_loaded[col]):
+                    dtype_map[col] = 'float32'
+            elif gdf_loaded[col].nunique(dropna=True) <= len(gdf_loaded) // 2:
+                dtype_map[col] = 'category' # Other repetitive text columns are dictionary-encoded too
+        try:
+            gdf_loaded = gdf_loaded.astype(dtype_map, copy=False)
+        except (ValueError, TypeError) as e_opt:
+            # A float32 target holds non-numeric text; convert column by column, coercing text columns only
+            # when they are mostly numeric (>90% parse) so a real text column is never wiped to NaN
+            print(f"Warning: Single-pass type conversion failed ({e_opt}), converting columns individually.")
+            for col, dtype in dtype_map.items():
+                if dtype == 'float32' and not pd.api.types.is_numeric_dtype(gdf_loaded[col].dtype):
+                    numeric_values = pd.to_numeric(gdf_loaded[col], errors='coerce')
+                    if numeric_values.notna().sum() > 0.9 * len(gdf_loaded):
+                        gdf_loaded[col] = numeric_values.astype('float32')
+                    else:
+                        print(f"Warning: Column '{col}' is mostly non-numeric text, leaving it as {gdf_loaded[col].dtype}.")
+                else:
+                    gdf_loaded[col] = gdf_loaded[col].astype(dtype)
         print("GeoDataFrame optimization attempt finished.")
 
+        # --- Split Off the Geometry ---
+        # Reproject once to WGS84 (EPSG:4326), the CRS every response is served in
+        geometries = np.asarray(gdf_loaded.geometry.values)
+        if gdf_loaded.crs is None:
+             print("Warning: GeoJSON has no CRS, assuming EPSG:4326.")
+        elif gdf_loaded.crs.to_epsg() != 4326:
+             print(f"Reprojecting geometries from {gdf_loaded.crs} to EPSG:4326...")
+             geometries = reproject_to_wgs84(geometries, gdf_loaded.crs)
+        # Geometry never changes, so its GeoJSON is rendered once (vectorized) and reused by every response
+        geometry_json = [geom.encode() if geom is not None else b'null' for geom in shapely.to_geojson(geometries)]
+        attributes_df = pd.DataFrame(gdf_loaded.drop(columns='geometry'))
+        del gdf_loaded, geometries
+
         # --- Assign to global variables ---
-        global_gdf = gdf_loaded
-        available_geojson_columns = global_gdf.columns.tolist() # Update based on final gdf
+        # Row order of global_gdf must stay fixed from here on, it is aligned with global_geometry_json
+        global_gdf = attributes_df
+        global_props_table = pa.Table.from_pandas(attributes_df, preserve_index=False)
+        global_geometry_json = geometry_json
+        # Hash index keyed like the aggregation output (int64 tracts), so generated index values are
+        # aligned with a single get_indexer call instead of merging or re-casting keys per request
+        tract_keys = global_gdf['Origin_tract']
+        if tract_keys.duplicated().any(): print("WARNING: Duplicate Origin_tract values in GeoJSON; index values will be assigned to one row per tract.")
+        keep_rows = (tract_keys.notna() & ~tract_keys.duplicated(keep='last')).to_numpy()
+        tract_index = pd.Index(tract_keys[keep_rows].to_numpy(dtype=np.int64))
+        tract_index_rows = np.flatnonzero(keep_rows)
+        available_geojson_columns = dict.fromkeys(global_gdf.columns) # Update based on final gdf
         verified_frontend_cols = temp_verified_frontend_cols # Set global list
+        frontend_columns_cache = {} # Columns depend on the data just loaded
+
+        # Static frontend properties never change after load, so they are serialized once per feature
+        static_columns = [col for col in get_columns_for_frontend() if col != 'geometry']
+        static_props_json = []
+        for batch in frontend_properties(static_columns).to_batches():
+            static_props_json.extend(orjson.dumps(props, default=json_default)[1:-1] for props in batch.to_pylist())
+        static_property_columns = set(static_columns)
+        global_static_props_json = static_props_json
 
         # Identify available variables for residential index (based on _zscore_o columns)
-        global available_residential_vars_js
-        temp_available_residential_vars_js = []
+        global available_residential_vars_js, residential_zscore_cols_js
+        temp_residential_zscore_cols_js = {}
         print("Checking available _zscore_o columns for residential indices...")
         for js_var, backend_cleaned_name in variable_name_map_js_to_backend.items():
              zscore_col = f"{backend_cleaned_name}_zscore_o"
              if zscore_col in available_geojson_columns:
-                  temp_available_residential_vars_js.append(js_var)
-        available_residential_vars_js = temp_available_residential_vars_js
+                  temp_residential_zscore_cols_js[js_var] = zscore_col
+        residential_zscore_cols_js = temp_residential_zscore_cols_js
+        available_residential_vars_js = list(temp_residential_zscore_cols_js)
         print(f"JS variable names usable for residential index: {available_residential_vars_js}")
-
+        # Residential indices average _zscore_o columns row-wise; gathering them from one contiguous
+        # buffer per request is cheaper than slicing and re-boxing global_gdf columns
+        zscore_cols = [col for col in global_gdf.columns if col.endswith('_zscore_o') and pd.api.types.is_float_dtype(global_gdf[col].dtype)]
+        zscore_matrix = np.ascontiguousarray(global_gdf[zscore_cols].to_numpy(dtype=np.float32, na_value=np.nan))
+        zscore_column_index = {col: position for position, col in enumerate(zscore_cols)}
+        digest = hashlib.sha1(zscore_matrix.data)
+        digest.update(','.join(zscore_cols).encode())
+        zscore_matrix_digest = digest.hexdigest()
+        residential_index_values.cache_clear() # Memoized indices refer to the previous matrix
+        print(f"Cached {len(zscore_cols)} _zscore_o columns as a {zscore_matrix.shape} float32 matrix.")
+
+        # Drop the GeoDataFrame/Arrow read buffers now rather than at the next allocation peak
+        gc.collect()
+        pa.default_memory_pool().release_unused()
         report_memory("After GeoJSON Load")
         return True # Success
 
@@ -242,69 +662,93 @@ def load_geojson_from_b2():
         print(f"Error loading/processing GeoJSON data from B2 key '{GEOJSON_OBJECT_KEY}': {e}")
         traceback.print_exc()
         global_gdf = None # Ensure it's None on failure
+        global_props_table = None
+        global_static_props_json = None
+        global_geometry_json = None
+        zscore_matrix = None
         return False # Failure
 
 
 def load_parquet_from_b2():
-    """Loads Parquet data from B2 into the global parquet_df."""
-    global parquet_df, s3_client
-    # Requires pyarrow and pandas to be installed
-    # Make sure pyarrow is imported: import pyarrow.parquet as pq
-    # Make sure pandas is imported: import pandas as pd
-    # Make sure io is imported: import io
-
+    """
+    Downloads the Parquet file from B2 to local disk, sorted by Origin_tract.
+    Only Origin_tract is read here; other columns are read per request as needed.
+    """
+    global parquet_buffer, parquet_columns, parquet_tract_ids, parquet_group_starts, parquet_perc_visit, parquet_metadata, s3_client
     if not s3_client: return False
     if not B2_BUCKET_NAME: print("Error: B2_BUCKET_NAME not configured."); return False
 
-    print(f"Attempting to load Parquet key '{PARQUET_OBJECT_KEY}' from B2 bucket '{B2_BUCKET_NAME}'...")
+    # Download and sort in a private temp directory (several workers may load concurrently on startup);
+    # the sorted file is only kept alive by this process's memory map
+    work_dir = tempfile.mkdtemp(prefix='full_data_')
+    download_path = os.path.join(work_dir, 'download.parquet')
+    sorted_path = os.path.join(work_dir, 'sorted.parquet')
+    print(f"Attempting to download Parquet key '{PARQUET_OBJECT_KEY}' from B2 bucket '{B2_BUCKET_NAME}' to '{work_dir}'...")
     try:
-        response = s3_client.get_object(Bucket=B2_BUCKET_NAME, Key=PARQUET_OBJECT_KEY)
-        buffer = io.BytesIO(response['Body'].read())
-        print(f"Reading Parquet table from buffer (size: {buffer.getbuffer().nbytes} bytes)...")
-        # Read using pyarrow first
-        import pyarrow.parquet as pq
-        parquet_table = pq.read_table(buffer)
-        # Convert to Pandas DataFrame
-        import pandas as pd
-        parquet_df_loaded = parquet_table.to_pandas()
-        print(f"Successfully loaded Parquet data from B2 key: {PARQUET_OBJECT_KEY}. Shape: {parquet_df_loaded.shape}")
-
-        # --- Process Loaded DataFrame ---
-        # Robust Origin_tract Conversion (important!)
-        if 'Origin_tract' in parquet_df_loaded.columns:
-             try:
-                 numeric_tracts_pq = pd.to_numeric(parquet_df_loaded['Origin_tract'], errors='coerce')
-                 if numeric_tracts_pq.isna().any(): print(f"WARNING: Some Origin_tract values in Parquet were non-numeric.")
-                 try: int_tracts_pq = numeric_tracts_pq.astype(pd.Int64Dtype())
-                 except TypeError: int_tracts_pq = numeric_tracts_pq.astype('float64').astype('Int64') # Fallback
-                 parquet_df_loaded['Origin_tract'] = int_tracts_pq.astype(str).str.strip()
-                 print(f"DEBUG: Post-load Origin_tract Parquet sample (string): {parquet_df_loaded['Origin_tract'].head()}")
-             except Exception as e_tract_pq:
-                  print(f"ERROR processing Origin_tract in Parquet: {e_tract_pq}"); return False
-        else:
+        s3_client.download_file(B2_BUCKET_NAME, PARQUET_OBJECT_KEY, download_path)
+        print(f"Successfully downloaded Parquet data from B2 key: {PARQUET_OBJECT_KEY} ({os.path.getsize(download_path)} bytes)")
+
+        # --- Validate Schema ---
+        schema_columns = set(pq.read_schema(download_path).names)
+        if 'Origin_tract' not in schema_columns:
              print("FATAL ERROR: Parquet file missing 'Origin_tract' column.")
              return False
+        if 'perc_visit' not in schema_columns:
+             print("FATAL ERROR: Parquet file missing 'perc_visit' column.")
+             return False
 
-        # Optimize Data Types (Example for perc_visit)
-        if 'perc_visit' in parquet_df_loaded.columns:
-             try: parquet_df_loaded['perc_visit'] = pd.to_numeric(parquet_df_loaded['perc_visit'], downcast='float')
-             except Exception as e_opt_pq: print(f"Warning: Could not optimize 'perc_visit': {e_opt_pq}")
-        # Add optimization for other numeric columns (_zscore_d) if needed
-
-        # Assign to global variable
-        parquet_df = parquet_df_loaded
-        report_memory("After Parquet Load")
+        # --- Rewrite Sorted by Origin_tract ---
+        # Normalizes Origin_tract to an integer key and sorts by it, so each tract's rows are
+        # one contiguous run and activity indices reduce to a single np.add.reduceat pass.
+        # _zscore_d and perc_visit are stored as float32, halving the bytes read per request.
+        # Rows with a zero/null perc_visit never contribute to an index, so they are dropped here.
+        replace_exprs = ['TRY_CAST(TRY_CAST("Origin_tract" AS DOUBLE) AS BIGINT) AS "Origin_tract"']
+        for col in sorted(schema_columns):
+            if col.endswith('_zscore_d') or col == 'perc_visit':
+                replace_exprs.append(f'CAST({quote_ident(col)} AS FLOAT) AS {quote_ident(col)}')
+        download_source = download_path.replace("'", "''")
+        sorted_target = sorted_path.replace("'", "''")
+        duck_con.execute(f"""
+            COPY (
+                SELECT * REPLACE ({', '.join(replace_exprs)})
+                FROM read_parquet('{download_source}')
+                WHERE TRY_CAST(TRY_CAST("Origin_tract" AS DOUBLE) AS BIGINT) IS NOT NULL
+                  AND "perc_visit" IS NOT NULL AND "perc_visit" != 0
+                ORDER BY "Origin_tract"
+            ) TO '{sorted_target}' (FORMAT PARQUET)
+        """)
+        os.remove(download_path) # The raw download is no longer needed
+        # Map the sorted file, then unlink it: the mapping stays valid (POSIX) and no second copy stays on disk
+        with pa.memory_map(sorted_path) as mapped_file: sorted_buffer = mapped_file.read_buffer() # Zero-copy, outlives the handle
+        os.remove(sorted_path)
+
+        # --- Locate Tract Groups & Cache Weights ---
+        key_table = pq.read_table(pa.BufferReader(sorted_buffer), columns=['Origin_tract', 'perc_visit'])
+        tract_ids = key_table['Origin_tract'].to_numpy()
+        perc_visit = key_table['perc_visit'].to_numpy()
+        del key_table
+        group_starts = np.flatnonzero(np.r_[True, tract_ids[1:] != tract_ids[:-1]]) if len(tract_ids) else np.array([], dtype=np.int64)
+        print(f"Parquet data sorted: {len(tract_ids)} rows in {len(group_starts)} tract groups.")
+
+        # Assign to global variables
+        parquet_buffer = sorted_buffer
+        parquet_columns = schema_columns
+        parquet_metadata = pq.read_metadata(pa.BufferReader(sorted_buffer))
+        parquet_tract_ids = tract_ids[group_starts]
+        parquet_group_starts = group_starts
+        parquet_perc_visit = perc_visit
+        del tract_ids
+        gc.collect()
+        pa.default_memory_pool().release_unused() # Return the Arrow read buffers to the OS
         return True # Success
 
-    except ImportError:
-         print("Error loading Parquet: 'pyarrow' or 'pandas' library not found.")
-         parquet_df = None
-         return False
     except Exception as e:
-        print(f"Error loading/processing Parquet data from B2 key '{PARQUET_OBJECT_KEY}': {e}")
+        print(f"Error downloading/preparing Parquet data from B2 key '{PARQUET_OBJECT_KEY}': {e}")
         traceback.print_exc()
-        parquet_df = None # Ensure it's None on failure
+        parquet_buffer = None # Ensure it's None on failure
         return False # Failure
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 # --- Variable Definitions (Frontend Needs - Executed once at startup) ---
 # Define these before loading data as they are used in checks
@@ -340,6 +784,9 @@ required_frontend_cols_in_geojson = sorted(list(set([
 
 # --- Initialize S3 Client and Load Data on Startup ---
 print("--- Initializing S3 Client & Loading Data ---")
+duck_con = duckdb.connect(database=':memory:', read_only=False)
+duck_con.execute(f"SET threads TO {os.cpu_count() or 1}")
+duck_con.execute(f"SET memory_limit = '{DUCKDB_MEMORY_LIMIT}'") # Larger sorts spill to disk instead of growing RSS
 if initialize_s3_client():
     # Load data only if client initialization succeeded
     geojson_loaded_ok = load_geojson_from_b2()
@@ -354,12 +801,32 @@ print("--- Data loading attempt finished ---")
 
 # --- Flask Routes ---
 
+# Pre-serialized 503 bodies for the endpoints that need loaded data (see require_loaded_data);
+# the activity body is None because it names whichever inputs are missing
+data_not_loaded_bodies = {
+    'geojson': orjson.dumps({"error": "Map data not loaded on server."}),
+    'generate_activity_index': None,
+    'generate_residential_index': orjson.dumps({"error": "Map data not loaded."}),
+}
+
+@app.before_request
+def require_loaded_data():
+    """Short-circuits data endpoints with a 503 when the data they need failed to load."""
+    if request.endpoint not in data_not_loaded_bodies or 'logged_in' not in session: return None # login_required handles anonymous users
+    missing = []
+    if global_gdf is None: missing.append("GeoJSON")
+    if parquet_buffer is None and request.endpoint == 'generate_activity_index': missing.append("Parquet")
+    if not missing: return None
+    logger.error("Error in /%s: required data not loaded: %s", request.endpoint, ' '.join(missing))
+    body = data_not_loaded_bodies[request.endpoint] or orjson.dumps({"error": "Required data not loaded: " + ' '.join(missing)})
+    return Response(body, status=503, mimetype='application/json') # Service Unavailable
+
 @app.route('/')
 @login_required
 def index():
     """Serves the main HTML page."""
     # Optionally check if data loaded before rendering
-    if global_gdf is None or parquet_df is None:
+    if global_gdf is None or parquet_buffer is None:
          flash("Error: Essential application data failed to load.", "danger")
          # Maybe render a simple error template or redirect?
          # return render_template('error.html', message="Data Load Error"), 500
@@ -371,13 +838,14 @@ def login():
     # ... (Keep your existing login logic) ...
     if request.method == 'POST':
         entered_passcode = request.form.get('passcode')
-        # Debug prints can be removed later
-        print(f"--- Login Attempt ---"); print(f"Entered: {repr(entered_passcode)}"); print(f"Expected: {repr(CORRECT_PASSCODE)}")
-        if entered_passcode and entered_passcode == CORRECT_PASSCODE:
+        logger.debug("Login attempt")
+        # Constant-time compare on bytes (compare_digest only accepts ASCII str)
+        if entered_passcode and CORRECT_PASSCODE and hmac.compare_digest(entered_passcode.encode(), CORRECT_PASSCODE.encode()):
             session['logged_in'] = True; session.permanent = True
             flash('You were successfully logged in!', 'success'); next_page = request.args.get('next')
             return redirect(next_page or url_for('index'))
         else:
+            logger.info("Rejected login attempt with an invalid passcode")
             flash('Invalid passcode. Please try again.', 'danger')
     return render_template('login.html')
 
@@ -393,37 +861,23 @@ def logout():
 @login_required
 def geojson():
     """Serves the current GeoJSON data needed by the frontend."""
-    global global_gdf
-    print("Request received for /geojson")
-    if global_gdf is None:
-         print("Error in /geojson: global_gdf is None.")
-         return jsonify({"error": "Map data not loaded on server."}), 503 # Service Unavailable
+    logger.debug("Request received for /geojson")
 
     try:
         cols_to_send = get_columns_for_frontend()
-        # print(f"Sending GeoJSON with columns ({len(cols_to_send)}): {cols_to_send}") # Verbose log
+        logger.debug("Sending GeoJSON with columns (%d): %s", len(cols_to_send), cols_to_send)
 
         if 'geometry' not in cols_to_send:
-             print("ERROR: No 'geometry' column found in columns to send.")
+             logger.error("No 'geometry' column found in columns to send.")
              return jsonify({"error": "Internal error preparing map data (geometry missing)."}), 500
 
-        # Create a VIEW (or copy() if mutations elsewhere are problematic) for sending
-        # Using a view is generally more memory efficient if gdf isn't modified during send
-        gdf_to_send = global_gdf[cols_to_send]
-
-        # Convert to GeoJSON interface and return
-        # Ensure CRS is set correctly before conversion if necessary (B2 loaded data might lose CRS)
-        if gdf_to_send.crs is None:
-             print("Warning: CRS not set on gdf_to_send, assuming EPSG:4326 for GeoJSON output.")
-             # If you know the original CRS, set it here: gdf_to_send.set_crs(epsg=YOUR_ORIGINAL_EPSG, inplace=True)
-        # Convert to WGS84 (EPSG:4326) which is standard for GeoJSON
-        geo_interface = gdf_to_send.to_crs(epsg=4326).__geo_interface__
-        print("GeoJSON conversion successful, sending response.")
-        return jsonify(geo_interface)
+        # Geometry GeoJSON (EPSG:4326) and static properties are pre-rendered on load; only the
+        # generated index columns (an immutable Arrow selection) are serialized while streaming
+        logger.debug("Streaming GeoJSON response.")
+        return feature_collection_response(cols_to_send)
 
     except Exception as e:
-        print(f"Error in /geojson: {e}")
-        traceback.print_exc()
+        logger.exception("Error in /geojson: %s", e)
         return jsonify({"error": f"Error preparing GeoJSON for display: {str(e)}"}), 500
 
 @app.route('/get_index_fields')
@@ -438,14 +892,8 @@ def get_index_fields():
 @login_required
 def generate_activity_index():
     """Generates an Activity Space Index using Parquet data and merges into global_gdf."""
-    global global_gdf, parquet_df, generated_index_columns, available_geojson_columns
-    print("\n--- Received request for /generate_index (Activity) ---")
-
-    if global_gdf is None or parquet_df is None:
-        error_msg = "Required data not loaded:"
-        if global_gdf is None: error_msg += " GeoJSON"
-        if parquet_df is None: error_msg += " Parquet"
-        return jsonify({"error": error_msg}), 503
+    global global_gdf, generated_index_values, available_geojson_columns
+    logger.debug("--- Received request for /generate_index (Activity) ---")
 
     # --- Extract and Validate Inputs ---
     data = request.get_json()
@@ -456,10 +904,10 @@ def generate_activity_index():
     if not selected_vars_js: return jsonify({"error": "No variables selected."}), 400
 
     # Clean name
-    cleaned_base_name = re.sub(r'[^\w_]', '', re.sub(r'\s+', '_', base_name_from_user))
+    cleaned_base_name = clean_index_name(base_name_from_user)
     if not cleaned_base_name: return jsonify({"error": "Invalid index name after cleaning."}), 400
     index_col_name = f"{cleaned_base_name}_ACT"
-    print(f"Generating Activity Index: '{index_col_name}'")
+    logger.info("Generating Activity Index: '%s'", index_col_name)
 
     # Map JS names to backend names and identify required Parquet columns (_zscore_d)
     selected_vars_backend, invalid_vars_received, required_zscore_d_cols_for_request = [], [], []
@@ -470,150 +918,109 @@ def generate_activity_index():
             # Activity index uses _zscore_d columns from the PARQUET file
             required_zscore_d_cols_for_request.append(f"{backend_name}_zscore_d")
         else: invalid_vars_received.append(var_js)
-    if invalid_vars_received: print(f"WARNING: Ignoring unknown variables: {invalid_vars_received}")
+    if invalid_vars_received: logger.warning("Ignoring unknown variables: %s", invalid_vars_received)
     if not selected_vars_backend: return jsonify({"error": "No valid variables selected."}), 400
-    print(f"Required _zscore_d columns from Parquet: {required_zscore_d_cols_for_request}")
+    logger.debug("Required _zscore_d columns from Parquet: %s", required_zscore_d_cols_for_request)
 
-    # Check if required columns exist in the loaded parquet_df
-    missing_parquet_cols = [col for col in required_zscore_d_cols_for_request if col not in parquet_df.columns]
+    # Check if required columns exist in the Parquet file schema
+    missing_parquet_cols = [col for col in required_zscore_d_cols_for_request if col not in parquet_columns]
     if missing_parquet_cols:
-        print(f"ERROR: Required columns missing from Parquet data: {missing_parquet_cols}")
+        logger.error("Required columns missing from Parquet data: %s", missing_parquet_cols)
         return jsonify({"error": f"Required data columns missing from source: {', '.join(missing_parquet_cols)}"}), 400
-    if 'perc_visit' not in parquet_df.columns:
+    if 'perc_visit' not in parquet_columns:
          return jsonify({"error": f"Required data column 'perc_visit' missing from source."}), 400
 
-    # --- DuckDB Query for Weighted Sum ---
-    # DuckDB can query Pandas DataFrames directly in memory
-    con = None
-    index_by_tract_df = pd.DataFrame()
+    # --- Vectorized Weighted Sum ---
+    # Rows are sorted by tract on load, so each tract is one contiguous run and the
+    # per-tract SUM becomes np.add.reduceat over the row-wise weighted sums
+    num_vars = len(selected_vars_backend)
     try:
-        print("Connecting to in-memory DuckDB to query Parquet DataFrame...")
-        con = duckdb.connect(database=':memory:', read_only=False)
-
-        # Create SQL expression for the weighted sum
-        weighted_sum_expr_parts = [f'"{col}"::DOUBLE * "perc_visit"::DOUBLE' for col in required_zscore_d_cols_for_request]
-        weighted_sum_sql = " + ".join(weighted_sum_expr_parts)
-        if not weighted_sum_sql: return jsonify({"error": "Internal error: Failed to build query sum expression."}), 500
-
-        # Ensure Origin_tract is string for grouping
-        # Note: DuckDB might handle mixed types, but explicit check is safer
-        if not pd.api.types.is_string_dtype(parquet_df['Origin_tract']):
-             print("Warning: Converting Parquet Origin_tract to string for DuckDB query.")
-             parquet_df['Origin_tract'] = parquet_df['Origin_tract'].astype(str).str.strip()
-
-        # Build and execute the query using the DataFrame `parquet_df` as the source table
-        query = f"""
-            SELECT
-                "Origin_tract",
-                SUM({weighted_sum_sql}) AS total_weighted_sum
-            FROM parquet_df -- Query the pandas DataFrame directly!
-            WHERE "perc_visit" IS NOT NULL AND "perc_visit" != 0
-            GROUP BY "Origin_tract"
-        """
-        # print(f"Executing DuckDB Query:\n{query}") # Can be verbose
-        index_by_tract_df = con.execute(query).fetchdf() # fetchdf returns a pandas DataFrame
-        print(f"DuckDB query returned {len(index_by_tract_df)} aggregated rows.")
+        # A ParquetFile per request (own reader position, thread-safe) over the pinned mapping and cached footer
+        with pq.ParquetFile(pa.BufferReader(parquet_buffer), metadata=parquet_metadata) as parquet_file:
+            table = parquet_file.read(columns=required_zscore_d_cols_for_request)
+        zscore_sum = np.zeros(table.num_rows, dtype=np.float64) # Columns stored as float32, accumulate in float64
+        for col in required_zscore_d_cols_for_request:
+            zscore_sum += table[col].to_numpy()
+        del table
+
+        # Zero/null-weight rows were dropped on load; a row with any null term contributes nothing
+        # (matches SQL SUM semantics)
+        row_sums = zscore_sum * parquet_perc_visit
+        valid_rows = ~np.isnan(row_sums)
+        row_sums[~valid_rows] = 0.0
+        if len(parquet_group_starts):
+            tract_sums = np.add.reduceat(row_sums, parquet_group_starts)
+            tract_counts = np.add.reduceat(valid_rows.astype(np.int64), parquet_group_starts)
+        else:
+            tract_sums = tract_counts = np.array([], dtype=np.float64)
+        has_rows = tract_counts > 0 # Tracts with no contributing rows get no value
+
+        # Final index value is the average weighted sum * 100, kept as plain arrays (no DataFrame);
+        # float32 for memory, with infinities cleaned to NaN
+        index_tract_ids = parquet_tract_ids[has_rows]
+        index_values = (tract_sums[has_rows] / num_vars * 100.0).astype(np.float32)
+        index_values[~np.isfinite(index_values)] = np.nan
+        del zscore_sum, row_sums, valid_rows
+        logger.debug("Aggregation returned %d tract rows.", len(index_tract_ids))
 
     except Exception as e:
-        print(f"ERROR: DuckDB query failed: {e}"); traceback.print_exc()
+        logger.exception("Aggregation failed: %s", e)
         # Attempt to provide a more specific error
         err_msg = f"Data query failed during aggregation. Error: {e}"
-        # Add more specific error checks if needed (e.g., column not found)
         return jsonify({"error": err_msg}), 500
-    finally:
-        if con: con.close()
 
-    # --- Process Results & Prepare for Merge ---
-    if index_by_tract_df.empty:
-        print(f"WARNING: DuckDB query returned no results for activity index.")
-        # Create empty df with correct columns/types to avoid merge errors
-        index_by_tract_df = pd.DataFrame({'Origin_tract': pd.Series(dtype='object'), 'total_weighted_sum': pd.Series(dtype='float64')})
+    if not len(index_tract_ids): logger.warning("Aggregation returned no results for activity index.")
 
-    # Robust Origin_tract Conversion (DuckDB might return different types)
-    if 'Origin_tract' in index_by_tract_df.columns:
-        try:
-            numeric_tracts = pd.to_numeric(index_by_tract_df['Origin_tract'], errors='coerce')
-            if numeric_tracts.isna().any(): print(f"WARNING: Some Origin_tracts from DuckDB were non-numeric.")
-            try: int_tracts = numeric_tracts.astype(pd.Int64Dtype())
-            except TypeError: int_tracts = numeric_tracts.astype('float64').astype('Int64')
-            index_by_tract_df["Origin_tract"] = int_tracts.astype(str).str.strip()
-        except Exception as e_tract_agg: print(f"ERROR processing Origin_tract from aggregation: {e_tract_agg}"); return jsonify({"error": "Failed post-processing tract IDs."}), 500
-    else: return jsonify({"error": "Internal error: Origin_tract missing post-aggregation."}), 500
-
-    # Calculate the final index value (Average weighted sum * 100)
-    num_vars = len(selected_vars_backend)
-    if num_vars > 0 and 'total_weighted_sum' in index_by_tract_df.columns:
-        total_sum = pd.to_numeric(index_by_tract_df["total_weighted_sum"], errors='coerce').replace([np.inf, -np.inf], np.nan)
-        index_by_tract_df[index_col_name] = (total_sum / num_vars * 100.0).astype('float32') # Use float32 for memory
-    else:
-        index_by_tract_df[index_col_name] = np.nan
-        print(f"WARNING: Calculation for '{index_col_name}' resulted in NaN (num_vars={num_vars}).")
-
-    # Select columns for merge ('Origin_tract' and the new index column)
-    index_to_merge = index_by_tract_df[["Origin_tract", index_col_name]].copy()
-
-    # --- Merge into global_gdf ---
+    # --- Align with global_gdf rows (index-aligned, no merge) ---
     try:
-        print(f"Merging '{index_col_name}' into global_gdf...")
-        # Drop existing column from global_gdf if necessary
-        if index_col_name in global_gdf.columns:
-            print(f"  Dropping existing column '{index_col_name}' from global_gdf.")
-            global_gdf = global_gdf.drop(columns=[index_col_name])
-            # Also remove from state tracking lists if present
-            if index_col_name in available_geojson_columns: available_geojson_columns.remove(index_col_name)
-            if index_col_name in generated_index_columns: generated_index_columns.remove(index_col_name)
-
-        # Ensure merge keys are compatible strings
-        if not pd.api.types.is_string_dtype(global_gdf['Origin_tract']):
-             print("Warning: Converting global_gdf Origin_tract to string before merge.")
-             global_gdf['Origin_tract'] = global_gdf['Origin_tract'].astype(str).str.strip()
-        if not pd.api.types.is_string_dtype(index_to_merge['Origin_tract']):
-             print("Warning: Converting index_to_merge Origin_tract to string before merge.")
-             index_to_merge['Origin_tract'] = index_to_merge['Origin_tract'].astype(str).str.strip()
-
-        # Perform the merge
-        original_rows = len(global_gdf)
-        global_gdf = global_gdf.merge(index_to_merge, on="Origin_tract", how="left")
+        logger.debug("Aligning '%s' with global_gdf rows...", index_col_name)
+        # Look up each aggregated (int64) tract in the load-time hash index and scatter the values
+        # into a preallocated column stored beside global_gdf, which is never widened or reordered
+        index_col = np.full(len(global_gdf), np.nan, dtype=np.float32)
+        positions = tract_index.get_indexer(index_tract_ids)
+        matched = positions >= 0
+        target_rows = tract_index_rows[positions[matched]]
+        index_col[target_rows] = index_values[matched]
+        set_index_column(index_col_name, index_col)
 
         # Validation checks
-        if len(global_gdf) != original_rows: print(f"WARNING: Row count changed after merge! {original_rows} -> {len(global_gdf)}")
-        if index_col_name not in global_gdf.columns: raise ValueError(f"Column '{index_col_name}' missing after merge.")
-        merged_nan_count = global_gdf[index_col_name].isna().sum()
-        print(f"Merge complete for '{index_col_name}'. NaN count: {merged_nan_count} / {len(global_gdf)}")
-        if merged_nan_count == len(global_gdf): print(f"WARNING: All values for '{index_col_name}' are NaN after merge. Check key matching.")
-        print(f"Sample values post-merge:\n{global_gdf[index_col_name].head()}")
+        if (~matched).any(): logger.warning("%d aggregated tracts have no matching GeoJSON row.", (~matched).sum())
+        merged_nan_count = np.isnan(index_col).sum()
+        logger.debug("Assignment complete for '%s'. NaN count: %d / %d", index_col_name, merged_nan_count, len(global_gdf))
+        if merged_nan_count == len(global_gdf): logger.warning("All values for '%s' are NaN after assignment. Check key matching.", index_col_name)
+        logger.debug("Sample values post-assignment: %s", index_col[:5])
+        del index_col, positions, target_rows # Release per-request temporaries before building the response
 
     except Exception as e_merge:
-        print(f"ERROR: Failed during merge: {e_merge}"); traceback.print_exc()
+        logger.exception("Failed during assignment: %s", e_merge)
         return jsonify({"error": f"Failed to merge index results: {e_merge}"}), 500
 
     # --- Update State Tracking Variables ---
-    generated_index_columns.add(index_col_name)
-    if index_col_name not in available_geojson_columns: available_geojson_columns.append(index_col_name)
-    report_memory(f"After generating {index_col_name}")
-    del index_by_tract_df, index_to_merge; gc.collect() # Cleanup
+    available_geojson_columns[index_col_name] = None # No-op if already tracked
+    if logger.isEnabledFor(logging.DEBUG): report_memory(f"After generating {index_col_name}", deep=False)
+    del index_tract_ids, index_values
 
-    # --- Return FULL UPDATED GDF Slice ---
+    # --- Return only the new column (keyed by Origin_tract); the frontend already has the features ---
     try:
-        cols_to_send = get_columns_for_frontend()
-        if not cols_to_send: return jsonify({"error": "Internal error selecting columns for response."}), 500
-        gdf_to_send = global_gdf[cols_to_send].copy() # Send a copy
-        print(f"DEBUG Before Send (Activity): Final sample values of '{index_col_name}':\n{gdf_to_send[index_col_name].head()}")
-        return jsonify(gdf_to_send.to_crs(epsg=4326).__geo_interface__)
+        logger.debug("Before Send (Activity): Final sample values of '%s': %s", index_col_name, generated_index_values[index_col_name][:5])
+        response = index_values_response(index_col_name)
     except Exception as e_final:
-        print(f"ERROR: Failed during final GeoJSON conversion/send: {e_final}"); traceback.print_exc()
+        logger.exception("Failed during final index values conversion/send: %s", e_final)
         return jsonify({"error": f"Failed to format final data: {e_final}"}), 500
 
+    # --- Cleanup (once, after all temporaries are released) ---
+    gc.collect()
+    pa.default_memory_pool().release_unused() # Return freed Arrow buffers (Parquet reads) to the OS
+    return response
+
 
 # --- Generate Residential Index ---
 @app.route('/generate_residential_index', methods=['POST'])
 @login_required
 def generate_residential_index():
     """Generates a Residential Index using _zscore_o columns from global_gdf."""
-    global global_gdf, generated_index_columns, available_geojson_columns
-    print("\n--- Received request for /generate_residential_index ---")
-
-    if global_gdf is None: return jsonify({"error": "Map data not loaded."}), 503
+    global global_gdf, generated_index_values, available_geojson_columns
+    logger.debug("--- Received request for /generate_residential_index ---")
 
     # --- Extract and Validate Inputs ---
     data = request.get_json()
@@ -624,81 +1031,72 @@ def generate_residential_index():
     if not selected_vars_js: return jsonify({"error": "No variables selected."}), 400
 
     # Clean user name
-    cleaned_base_name = re.sub(r'[^\w_]', '', re.sub(r'\s+', '_', base_name_from_user))
+    cleaned_base_name = clean_index_name(base_name_from_user)
     if not cleaned_base_name: return jsonify({"error": "Invalid index name."}), 400
     index_col_name = f"{cleaned_base_name}_RES"
-    print(f"Generating Residential Index: '{index_col_name}'")
+    logger.debug("Generating Residential Index: '%s'", index_col_name)
 
     # --- Validate selected variables against AVAILABLE residential vars (_zscore_o columns) ---
-    required_zscore_o_cols = []; invalid_vars_for_residential = []
-    for var_js in selected_vars_js:
-        backend_name = variable_name_map_js_to_backend.get(var_js)
-        if not backend_name: print(f"WARNING: Ignoring unknown variable '{var_js}'"); continue
-        # Residential index uses _zscore_o columns from the GeoJSON/GDF
-        zscore_col = f"{backend_name}_zscore_o"
-        if zscore_col in available_geojson_columns: # Check against currently available columns in GDF
-             required_zscore_o_cols.append(zscore_col)
-        else:
-             print(f"WARNING: Required column '{zscore_col}' for variable '{var_js}' not found in current GDF.")
-             invalid_vars_for_residential.append(var_js)
+    # Residential index uses _zscore_o columns from the GeoJSON/GDF, resolved per JS name at load
+    required_zscore_o_cols = [residential_zscore_cols_js[var_js] for var_js in selected_vars_js if var_js in residential_zscore_cols_js]
+    unknown_vars = [var_js for var_js in selected_vars_js if var_js not in variable_name_map_js_to_backend]
+    invalid_vars_for_residential = [var_js for var_js in selected_vars_js
+                                    if var_js in variable_name_map_js_to_backend and var_js not in residential_zscore_cols_js]
+    if unknown_vars: logger.warning("Ignoring unknown variables: %s", unknown_vars)
+    if invalid_vars_for_residential: logger.warning("No _zscore_o column in current GDF for variables: %s", invalid_vars_for_residential)
 
     if not required_zscore_o_cols:
         error_msg = "None of the selected variables have required data (_zscore_o columns) available in the map data."
         if invalid_vars_for_residential: error_msg += f" (Missing data for: {', '.join(invalid_vars_for_residential)})"
         return jsonify({"error": error_msg}), 400
-    if invalid_vars_for_residential: print(f"WARNING: Calculating residential index '{index_col_name}' skipping unavailable variables: {', '.join(invalid_vars_for_residential)}")
-    print(f"Using GeoJSON columns: {required_zscore_o_cols}")
+    if invalid_vars_for_residential: logger.warning("Calculating residential index '%s' skipping unavailable variables: %s", index_col_name, ', '.join(invalid_vars_for_residential))
+    logger.debug("Using GeoJSON columns: %s", required_zscore_o_cols)
 
     # --- Calculate Index (Average of existing _zscore_o columns * 100) ---
     try:
-        # Select only the required columns that actually exist in the current GDF
-        cols_to_average = [col for col in required_zscore_o_cols if col in global_gdf.columns]
+        # Select only the required columns that actually exist in the cached z-score matrix
+        cols_to_average = [col for col in required_zscore_o_cols if col in zscore_column_index]
         if not cols_to_average: # Should not happen if previous check passed, but safety check
              return jsonify({"error": "No valid columns found in GeoDataFrame for averaging."}), 500
 
-        print(f"Calculating mean for columns: {cols_to_average}")
-        index_values = global_gdf[cols_to_average].mean(axis=1, skipna=True).astype('float32') * 100.0
+        logger.debug("Calculating mean for columns: %s", cols_to_average)
+        # Row-wise NaN-skipping mean over one contiguous float32 block (no float64 upcast), memoized per variable set
+        index_values = residential_index_values(tuple(sorted(cols_to_average)))
 
-        # --- Add/Update column in global_gdf & state lists ---
-        if index_col_name in global_gdf.columns:
-            print(f"Dropping existing column '{index_col_name}'.")
-            global_gdf = global_gdf.drop(columns=[index_col_name])
-            if index_col_name in available_geojson_columns: available_geojson_columns.remove(index_col_name)
-            if index_col_name in generated_index_columns: generated_index_columns.remove(index_col_name)
+        # --- Add/Update generated column & state lists ---
+        if index_col_name in generated_index_values: logger.debug("Overwriting existing column '%s'.", index_col_name)
+        set_index_column(index_col_name, index_values)
+        available_geojson_columns[index_col_name] = None # No-op if already tracked
 
-        global_gdf[index_col_name] = index_values
-        generated_index_columns.add(index_col_name)
-        if index_col_name not in available_geojson_columns: available_geojson_columns.append(index_col_name)
-
-        print(f"Added/Updated residential index '{index_col_name}'. Dtype: {global_gdf[index_col_name].dtype}, NaN Count: {global_gdf[index_col_name].isna().sum()}")
-        report_memory(f"After generating {index_col_name}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Added/Updated residential index '%s'. Dtype: %s, NaN Count: %d", index_col_name, index_values.dtype, np.isnan(index_values).sum())
+            report_memory(f"After generating {index_col_name}", deep=False)
 
     except Exception as e_calc:
-        print(f"ERROR during residential index calculation: {e_calc}"); traceback.print_exc()
+        logger.exception("Error during residential index calculation: %s", e_calc)
         return jsonify({"error": f"Calculation failed: {e_calc}"}), 500
 
     # --- Return FULL UPDATED GDF Slice ---
     try:
         cols_to_send = get_columns_for_frontend()
-        print(f"Returning updated GDF slice ({len(cols_to_send)} cols)")
+        logger.debug("Returning updated GDF slice (%d cols)", len(cols_to_send))
         if not cols_to_send or 'geometry' not in cols_to_send: return jsonify({"error": "Internal error selecting columns for response."}), 500
 
-        gdf_to_send = global_gdf[cols_to_send].copy() # Send a copy
-        print(f"DEBUG Before Send (Residential): Final sample values of '{index_col_name}':\n{gdf_to_send[index_col_name].head()}")
-
-        # Ensure CRS before converting
-        if gdf_to_send.crs is None:
-             print("Warning: Setting CRS to EPSG:4326 before GeoJSON conversion.")
-             gdf_to_send.set_crs(epsg=4326, inplace=True)
-        return jsonify(gdf_to_send.to_crs(epsg=4326).__geo_interface__)
+        logger.debug("Before Send (Residential): Final sample values of '%s': %s", index_col_name, generated_index_values[index_col_name][:5])
+        return feature_collection_response(cols_to_send)
 
     except Exception as e_final:
-        print(f"ERROR: Failed during final GeoJSON conversion/send for residential: {e_final}"); traceback.print_exc()
+        logger.exception("Failed during final GeoJSON conversion/send for residential: %s", e_final)
         return jsonify({"error": f"Failed to format final data for residential: {e_final}"}), 500
 
 # --- Main Execution Block ---
 # (Keep if __name__ == '__main__': block for local development)
 if __name__ == '__main__':
     print("Starting Flask Application for local development...")
-    # threaded=False can help debug state issues, but might impact performance
-    app.run(debug=True, threaded=False)
\ No newline at end of file
+    # Local development only. In production run under a WSGI server instead, e.g.:
+    #   gunicorn -k gthread -w 1 --threads 8 --timeout 120 wsgi:application
+    # One worker holds the loaded data; its threads overlap request I/O with the NumPy/JSON work.
+    # FLASK_DEBUG=1 enables the Werkzeug debugger/reloader; FLASK_THREADED=0 serializes requests
+    # (can help debug state issues).
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1',
+            threaded=os.environ.get('FLASK_THREADED', '1') == '1')
\ No newline at end of file
@@ -0,0 +1,25 @@
+"""
+One-time conversion of the tract GeoJSON to GeoParquet for faster app startup.
+
+GeoParquet is read column-wise with pyarrow and stores geometries as WKB, so the app
+skips JSON tokenization on load. Geometries are written in EPSG:4326, the CRS the app
+serves, so its load-time reprojection is skipped as well. Upload the output to B2 under GEOPARQUET_OBJECT_KEY
+(see app.py); the app falls back to the GeoJSON when that key is missing.
+
+Usage: python convert_to_geoparquet.py data_residential.geojson data_residential.geoparquet
+"""
+import sys
+import geopandas as gpd
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python convert_to_geoparquet.py <input.geojson> <output.geoparquet>")
+        sys.exit(1)
+    source_path, output_path = sys.argv[1], sys.argv[2]
+    gdf = gpd.read_file(source_path, engine='pyogrio', use_arrow=True)
+    print(f"Read {len(gdf)} features ({len(gdf.columns)} columns) from {source_path}")
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        print(f"Reprojecting geometries from {gdf.crs} to EPSG:4326...")
+        gdf = gdf.to_crs(epsg=4326)
+    gdf.to_parquet(output_path, compression='zstd', write_covering_bbox=True)
+    print(f"Wrote GeoParquet to {output_path}")
@@ -677,15 +677,41 @@ function makeDraggable(element, handle) {
 
 // --- Initial Data Loading & UI Setup ---
 
-document.addEventListener('DOMContentLoaded', () => {
-  // Initial fetch for GeoJSON data and setup
-  fetch('/geojson')
-    .then(res => {
-        if (!res.ok) {
-            throw new Error(`HTTP error! status: ${res.status}`);
+// Reads a GeoJSON Text Sequence (features separated by the RS character) while it streams in,
+// so features are parsed as they arrive, and resolves to a regular FeatureCollection.
+async function fetchFeatureSequence(url) {
+    const res = await fetch(url, { headers: { 'Accept': 'application/geo+json-seq' } });
+    if (!res.ok) {
+        throw new Error(`HTTP error! status: ${res.status}`);
+    }
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    const features = [];
+    let buffered = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        buffered += decoder.decode(value || new Uint8Array(), { stream: !done });
+        const records = buffered.split('\x1e');
+        buffered = done ? '' : records.pop(); // The last record may still be incomplete
+        for (const record of records) {
+            if (record.trim()) features.push(JSON.parse(record));
         }
-        return res.json();
-     })
+        if (done) break;
+    }
+    return { type: 'FeatureCollection', features: features };
+}
+
+// Copies a generated index column ({Origin_tract: value}) onto the loaded features; tracts without a value get null
+function mergeIndexValues(geojson, fieldName, valuesByTract) {
+    for (const feature of geojson.features) {
+        const value = valuesByTract[feature.properties.Origin_tract];
+        feature.properties[fieldName] = value === undefined ? null : value;
+    }
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+  // Initial fetch for GeoJSON data (streamed as a feature sequence) and setup
+  fetchFeatureSequence('/geojson?format=seq')
     .then(json => {
       if (json.error) { // Handle potential errors returned in JSON body
           throw new Error(`Server error: ${json.error}`);
@@ -1167,14 +1193,22 @@ async function generateIndex(endpoint, isActivity) {
         }
         return res.json(); // Parse JSON response
     })
-    .then(async geojson => { // Process successful response (async because generateLayerFromField is async)
+    .then(async payload => { // Process successful response (async because generateLayerFromField is async)
         // --- Validate response structure ---
-        if (!geojson || !geojson.features || geojson.features.length === 0) {
-             throw new Error("Received invalid or empty GeoJSON response from server.");
+        if (payload && payload.index_col && payload.values) {
+            // Only the new column came back (keyed by Origin_tract); merge it into the loaded features
+            if (!data || !data.features || data.features.length === 0) {
+                 throw new Error("Map data is not loaded yet, cannot add the generated index.");
+            }
+            mergeIndexValues(data, payload.index_col, payload.values);
+            console.log(`--- Merged ${indexType} index values into loaded data ---`);
+        } else {
+            if (!payload || !payload.features || payload.features.length === 0) {
+                 throw new Error("Received invalid or empty GeoJSON response from server.");
+            }
+            data = payload; // Update global data with the FULL response from backend
+            console.log(`--- Received GeoJSON after ${indexType} index generation ---`);
         }
-        data = geojson; // Update global data with the FULL response from backend
-
-        console.log(`--- Received GeoJSON after ${indexType} index generation ---`);
 
         // --- CRITICAL VALIDATION: Check if the expected fieldName exists in the returned data ---
         if (!(data.features[0].properties.hasOwnProperty(indexFieldName))) {
@@ -0,0 +1,10 @@
+"""
+WSGI entry point for production, e.g.:
+
+    gunicorn -k gthread -w 1 --threads 8 --timeout 120 wsgi:application
+
+Importing app loads the GeoJSON and Parquet data once. Keep a single worker: generated
+indices live in that process's memory, so separate workers would each see a different set.
+Scale with --threads instead; index column writes are serialized by index_column_lock.
+"""
+from app import app as application